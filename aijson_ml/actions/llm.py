@@ -1,15 +1,31 @@
+import asyncio
+import atexit
 import json
 import logging
 import os
+import re
 import tempfile
+import time
 import base64
+import contextlib
+import enum
+import functools
+import weakref
 from collections import defaultdict
 from json import JSONDecodeError
-from typing import Optional, AsyncIterator, Any
+from typing import (
+    Optional,
+    AsyncGenerator,
+    AsyncIterator,
+    Any,
+    ClassVar,
+    TYPE_CHECKING,
+)
 
 import aiohttp
 import openai
 import pydantic
+import pydantic_core
 import tenacity
 
 from aijson.models.config.action import ActionInvocation
@@ -34,7 +50,9 @@ from aijson.models.json_schema import JsonSchemaObject
 from aijson.utils.async_utils import Timer, measure_async_iterator
 from aijson.utils.json_schema_utils import jsonschema_to_pydantic
 from aijson.utils.secret_utils import get_secret
-from aijson.utils.singleton_utils import SingletonContext
+
+if TYPE_CHECKING:
+    from anthropic import AsyncAnthropic
 
 # for some reason if this is imported later it hangs consistently
 try:
@@ -55,6 +73,16 @@ retry_errors = (
     openai.OpenAIError,  # includes litellm errors
 )
 
+try:
+    # orjson is considerably faster on the streaming paths; its errors subclass JSONDecodeError
+    from orjson import loads as json_loads, dumps as json_dumps_bytes
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps_bytes(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+
 try:
     import anthropic
 
@@ -62,52 +90,165 @@ try:
 except ImportError:
     pass
 
+# `iter_chunked` yields as soon as any data arrives, up to this many bytes
+OLLAMA_READ_CHUNK_SIZE = 65536
 
-class PromptEnvContext(SingletonContext):
-    # push anthropic API key into env if not there, and
-    # inject the GCP credentials from the base64 encoded environment variable
-    # into an Application Default Credentials file,
-    # using a temporary file
+# the strategies are stateless, so they're shared across runs;
+# `AsyncRetrying` keeps per-attempt state though, so each run builds its own
+retry_wait = tenacity.wait_random_exponential(min=1, max=60)
+retry_condition = tenacity.retry_if_exception_type(retry_errors)
 
-    def __init__(self):
-        super().__init__()
-        self.anthropic_env_var_bak = None
-        self.gcp_env_var_bak = None
-        self.file = None
-
-    def enter(self):
-        anthropic_api_key = get_secret("ANTHROPIC_API_KEY")
-        if anthropic_api_key is not None:
-            self.anthropic_env_var_bak = os.environ.get("ANTHROPIC_API_KEY")
-            os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
-
-        base64_encoded_credentials = get_secret("GCP_CREDENTIALS_64")
-        if base64_encoded_credentials is not None:
-            credentials_string = base64.b64decode(base64_encoded_credentials).decode(
-                "ascii"
-            )
-            self.file = tempfile.NamedTemporaryFile(mode="w")
-            self.file.write(credentials_string)
-            self.file.flush()
-            self.gcp_env_var_bak = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.file.name
 
-    def exit(self, *args):
-        if self.file is not None:
-            self.file.close()
+@functools.lru_cache(maxsize=256)
+def _count_message_tokens(model: str, role: str, content: str) -> int:
+    return litellm.token_counter(  # pyright: ignore[reportPrivateImportUsage]
+        model=model,
+        messages=[{"role": role, "content": content}],
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _count_base_tokens(model: str) -> int:
+    # tokens litellm adds regardless of the messages (e.g. reply priming)
+    return litellm.token_counter(  # pyright: ignore[reportPrivateImportUsage]
+        model=model,
+        messages=[],
+    )
+
 
-        if self.anthropic_env_var_bak is not None:
-            os.environ["ANTHROPIC_API_KEY"] = self.anthropic_env_var_bak
-        elif "ANTHROPIC_API_KEY" in os.environ:
-            del os.environ["ANTHROPIC_API_KEY"]
+def count_message_tokens(model: str, messages: list[dict[str, str]]) -> int:
+    """
+    Approximates `litellm.token_counter(model=model, messages=messages)` as the sum of
+    per-message counts, caching each one so repeated prompt context is only tokenized once.
 
-        if self.gcp_env_var_bak is not None:
-            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.gcp_env_var_bak
-        elif "GOOGLE_APPLICATION_CREDENTIALS" in os.environ:
-            del os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
+    The sum is exact for OpenAI models, which litellm counts per message.
+    For tokenizers that count the joined text instead, it can differ slightly
+    (e.g. by a token or so per message).
+    """
+    base_tokens = _count_base_tokens(model)
+    return base_tokens + sum(
+        _count_message_tokens(model, message["role"], message["content"]) - base_tokens
+        for message in messages
+    )
 
 
-prompt_env_context_singleton = PromptEnvContext()
+class Provider(enum.Enum):
+    ANTHROPIC = "anthropic"
+    OLLAMA = "ollama"
+    OPENAI = "openai"
+    LITELLM = "litellm"
+
+
+@functools.lru_cache(maxsize=256)
+def get_provider(model: str) -> Provider:
+    """
+    Resolve which client a model is invoked with; anything without a native client goes through litellm.
+    """
+    if model.startswith("claude"):
+        return Provider.ANTHROPIC
+    if model.startswith("ollama/"):
+        return Provider.OLLAMA
+    if model.startswith("gpt"):
+        return Provider.OPENAI
+    return Provider.LITELLM
+
+
+# generous allowance for the role and chat-format tokens wrapped around each message
+_MESSAGE_TOKEN_OVERHEAD = 8
+
+
+def max_token_bound(messages: list[dict[str, str]]) -> int:
+    """
+    Cheap upper bound on the token count of `messages`, for any byte-level tokenizer.
+
+    Every token covers at least one byte, so a message can't have more tokens than
+    its content has UTF-8 bytes (`str.isascii` is O(1), so ASCII text isn't encoded).
+    """
+    return _MESSAGE_TOKEN_OVERHEAD + sum(
+        (
+            len(message["content"])
+            if message["content"].isascii()
+            else len(message["content"].encode())
+        )
+        + _MESSAGE_TOKEN_OVERHEAD
+        for message in messages
+    )
+
+
+def join_tool_responses(tool_responses: dict[int, list[str]]) -> dict[int, str]:
+    return {index: "".join(chunks) for index, chunks in tool_responses.items()}
+
+
+# characters that affect the structure of a JSON document; escape sequences match as a pair
+_JSON_STRUCTURE_PATTERN = re.compile(r'\\.|[\[\]{}"\\]', re.DOTALL)
+
+
+class JsonDepthTracker:
+    """
+    Tracks the bracket depth of a JSON document as it is streamed in,
+    ignoring brackets inside string literals.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Advance the state by `chunk`, returning whether a top-level value was closed within it.
+        """
+        closed = False
+        start = 0
+        if self.escaped and chunk:
+            # the previous chunk ended in a backslash, escaping this chunk's first character
+            self.escaped = False
+            start = 1
+        # only visit structural characters, skipping over plain text in C
+        for match in _JSON_STRUCTURE_PATTERN.finditer(chunk, start):
+            token = match.group()
+            if self.in_string:
+                if token == '"':
+                    self.in_string = False
+                elif token == "\\":
+                    self.escaped = True
+            elif token == '"':
+                self.in_string = True
+            elif token == "{" or token == "[":
+                self.depth += 1
+            elif token == "}" or token == "]":
+                self.depth -= 1
+                if self.depth == 0:
+                    closed = True
+        return closed
+
+
+# keeps the GCP credentials file alive (and on disk) for the lifetime of the process
+_gcp_credentials_file = None
+
+
+@functools.cache
+def configure_prompt_env():
+    # push anthropic API key into env if not there, and
+    # inject the GCP credentials from the base64 encoded environment variable
+    # into an Application Default Credentials file,
+    # using a temporary file;
+    # env vars are process-global, so this is done once rather than around every invocation
+    global _gcp_credentials_file
+
+    anthropic_api_key = get_secret("ANTHROPIC_API_KEY")
+    if anthropic_api_key is not None:
+        os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
+
+    base64_encoded_credentials = get_secret("GCP_CREDENTIALS_64")
+    if base64_encoded_credentials is not None:
+        credentials_string = base64.b64decode(base64_encoded_credentials).decode(
+            "ascii"
+        )
+        _gcp_credentials_file = tempfile.NamedTemporaryFile(mode="w")
+        _gcp_credentials_file.write(credentials_string)
+        _gcp_credentials_file.flush()
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = _gcp_credentials_file.name
 
 
 class Inputs(DefaultModelInputs):
@@ -160,6 +301,15 @@ If `output_schema` input is specified, this is a JSON string. Use `my_prompt.dat
     )
 
 
+@functools.lru_cache(maxsize=256)
+def _compile_schema(schema_json: bytes) -> pydantic.BaseModel:
+    schema_object = JsonSchemaObject(
+        type="object",
+        properties=json_loads(schema_json),
+    )
+    return jsonschema_to_pydantic(schema_object)
+
+
 class Prompt(StreamingAction[Inputs, Outputs]):
     name = "llm"
 
@@ -169,8 +319,147 @@ class Prompt(StreamingAction[Inputs, Outputs]):
 
     version = 0
 
+    #: Streamed deltas are buffered and yielded at most once per interval (in seconds),
+    #  or once this many deltas have been buffered;
+    #  buffered deltas are flushed when the interval passes, even if the stream stalls
+    stream_yield_interval: ClassVar[float] = 0.03
+    stream_yield_max_deltas: ClassVar[int] = 16
+
+    # one pooled session per event loop, so keep-alive connections are reused across calls
+    _sessions: ClassVar[
+        weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.ClientSession]
+    ] = weakref.WeakKeyDictionary()
+
+    # pending cleanup generators, which the event loop finalizes when it shuts down
+    _loop_cleanups: ClassVar[
+        weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncGenerator[None, None]]
+    ] = weakref.WeakKeyDictionary()
+
     @classmethod
-    def construct_model_from_schema(cls, schema: dict) -> pydantic.BaseModel | None:
+    async def _close_on_loop_shutdown(cls) -> AsyncGenerator[None, None]:
+        try:
+            yield
+        finally:
+            cls._loop_cleanups.pop(asyncio.get_running_loop(), None)
+            await cls._close_loop_resources()
+
+    @classmethod
+    async def _register_loop_cleanup(cls) -> asyncio.AbstractEventLoop:
+        """
+        Make sure everything cached for the running event loop is closed when it shuts down.
+
+        `asyncio.run` (and `loop.shutdown_asyncgens`) finalizes pending async generators
+        while the loop can still await, so a suspended generator closes the cache.
+        Loops that were closed without that step are forgotten here;
+        their resources can no longer be closed cleanly.
+        """
+        cls._forget_closed_loops()
+        loop = asyncio.get_running_loop()
+        if loop not in cls._loop_cleanups:
+            cleanup = cls._close_on_loop_shutdown()
+            await anext(cleanup)
+            cls._loop_cleanups[loop] = cleanup
+        return loop
+
+    @classmethod
+    def _forget_closed_loops(cls):
+        # cached values hold their loop strongly, so the weak keys never expire by themselves
+        for cache in (
+            cls._loop_cleanups,
+            cls._sessions,
+            cls._anthropic_clients,
+            cls._openai_clients,
+        ):
+            for loop in [loop for loop in cache if loop.is_closed()]:
+                del cache[loop]
+
+    @classmethod
+    async def _get_session(cls) -> aiohttp.ClientSession:
+        loop = await cls._register_loop_cleanup()
+        session = cls._sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=32,
+                    keepalive_timeout=75,
+                    ttl_dns_cache=300,
+                ),
+            )
+            cls._sessions[loop] = session
+        return session
+
+    # API clients hold httpx connection pools, which are also bound to the event loop
+    _anthropic_clients: ClassVar[
+        weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str | None, "AsyncAnthropic"]
+        ]
+    ] = weakref.WeakKeyDictionary()
+    _openai_clients: ClassVar[
+        weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str | None, openai.AsyncOpenAI]
+        ]
+    ] = weakref.WeakKeyDictionary()
+
+    @classmethod
+    async def _get_anthropic_client(cls, api_key: str | None) -> "AsyncAnthropic":
+        from anthropic import AsyncAnthropic
+
+        loop = await cls._register_loop_cleanup()
+        clients = cls._anthropic_clients.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            # retries are handled by tenacity in `run`
+            client = AsyncAnthropic(api_key=api_key, max_retries=0)
+            clients[api_key] = client
+        return client
+
+    @classmethod
+    async def _get_openai_client(cls, api_key: str | None) -> openai.AsyncOpenAI:
+        loop = await cls._register_loop_cleanup()
+        clients = cls._openai_clients.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+            clients[api_key] = client
+        return client
+
+    @classmethod
+    async def aclose_all(cls):
+        """
+        Close the HTTP session and API clients cached for the running event loop.
+        """
+        cleanup = cls._loop_cleanups.get(asyncio.get_running_loop())
+        if cleanup is not None:
+            await cleanup.aclose()
+        await cls._close_loop_resources()
+
+    @classmethod
+    async def _close_loop_resources(cls):
+        loop = asyncio.get_running_loop()
+        session = cls._sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+        for client in cls._anthropic_clients.pop(loop, {}).values():
+            await client.close()
+        for client in cls._openai_clients.pop(loop, {}).values():
+            await client.close()
+
+    @classmethod
+    def _close_all_sync(cls):
+        cls._forget_closed_loops()
+        loops = (
+            set(cls._sessions) | set(cls._anthropic_clients) | set(cls._openai_clients)
+        )
+        for loop in loops:
+            # a loop that is still running closes its cache when it shuts down
+            if not loop.is_running():
+                loop.run_until_complete(cls.aclose_all())
+
+    @classmethod
+    def resolve_schema(
+        cls, schema: dict
+    ) -> tuple[JsonSchemaObject | None, pydantic.BaseModel | None]:
         try:
             # TODO support parital inference; for `var:` and `link:` in schema
             #  honestly rewrite `jsonschema_to_pydantic` to work on dict instead of this obj
@@ -179,9 +468,15 @@ class Prompt(StreamingAction[Inputs, Outputs]):
                 properties=schema,
             )
         except ValueError:
-            return None
+            return None, None
+        # the schema object keeps track of which fields were set, so only the
+        #  compiled model is cached, by the schema's JSON serialization
+        model = _compile_schema(pydantic_core.to_json(schema, serialize_unknown=True))
+        return schema_object, model
 
-        return jsonschema_to_pydantic(schema_object)
+    @classmethod
+    def construct_model_from_schema(cls, schema: dict) -> pydantic.BaseModel | None:
+        return cls.resolve_schema(schema)[1]
 
     @classmethod
     def narrow_outputs_type(
@@ -210,6 +505,15 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         message_config: str | list[PromptElement],
         model_config: ModelConfig,
         quote_style: None | QuoteStyle,
+    ) -> list[dict[str, str]]:
+        messages = self.assemble_messages(message_config, model_config, quote_style)
+        return self.trim_messages(messages, model_config)
+
+    def assemble_messages(
+        self,
+        message_config: str | list[PromptElement],
+        model_config: ModelConfig,
+        quote_style: None | QuoteStyle,
     ) -> list[dict[str, str]]:
         if quote_style is None:
             if "claude" in model_config.model:
@@ -217,24 +521,17 @@ class Prompt(StreamingAction[Inputs, Outputs]):
             else:
                 quote_style = QuoteStyle.BACKTICKS
 
-        messages = []
-        current_role = "user"
-        current_message_elements = []
-
-        def deposit_messages(new_role: str):
-            nonlocal messages
-            nonlocal current_role
-            nonlocal current_message_elements
+        messages: list[dict[str, str]] = []
 
-            if current_message_elements:
+        def deposit_message(role: str, elements: list[str]):
+            if elements:
                 messages.append(
                     {
-                        "role": current_role,
-                        "content": "\n\n".join(current_message_elements),
+                        "role": role,
+                        "content": "\n\n".join(elements),
                     }
                 )
-            current_message_elements = []
-            current_role = new_role
+                elements.clear()
 
         if isinstance(message_config, str):
             messages += [
@@ -245,33 +542,38 @@ class Prompt(StreamingAction[Inputs, Outputs]):
                 }
             ]
         else:
+            current_role = "user"
+            current_message_elements: list[str] = []
             for prompt_element in message_config:
+                if isinstance(prompt_element, str):
+                    current_message_elements.append(prompt_element)
+                    continue
                 if isinstance(prompt_element, RoleElement):
-                    deposit_messages(prompt_element.role)
+                    deposit_message(current_role, current_message_elements)
+                    current_role = prompt_element.role
                     continue
-                elif isinstance(prompt_element, TextElement):
-                    role = prompt_element.role
-                    if role is not None:
-                        deposit_messages(role)
+                if (
+                    isinstance(prompt_element, TextElement)
+                    and prompt_element.role is not None
+                ):
+                    deposit_message(current_role, current_message_elements)
+                    current_role = prompt_element.role
+                current_message_elements.append(prompt_element.as_string(quote_style))
+            deposit_message(current_role, current_message_elements)
 
-                if isinstance(prompt_element, str):
-                    as_str = prompt_element
-                else:
-                    as_str = prompt_element.as_string(quote_style)
-                current_message_elements.append(as_str)
-            if current_message_elements:
-                messages.append(
-                    {
-                        "role": current_role,
-                        "content": "\n\n".join(current_message_elements),
-                    }
-                )
+        return messages
 
-        token_count = litellm.token_counter(  # pyright: ignore[reportPrivateImportUsage]
-            model=model_config.model,
-            messages=messages,
-        )
+    def trim_messages(
+        self,
+        messages: list[dict[str, str]],
+        model_config: ModelConfig,
+    ) -> list[dict[str, str]]:
         max_prompt_tokens = model_config.max_prompt_tokens
+        if max_token_bound(messages) <= max_prompt_tokens:
+            # comfortably under budget, no need to tokenize
+            return messages
+
+        token_count = count_message_tokens(model_config.model, messages)
         if token_count > max_prompt_tokens:
             self.log.warning(
                 "Trimming messages",
@@ -300,32 +602,27 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         messages: list[dict[str, str]],
         model_config: ModelConfig,
     ) -> AsyncIterator[tuple[str, int | None]]:
-        from anthropic import AsyncAnthropic
         from anthropic.types import MessageParam
         from anthropic import NOT_GIVEN
 
-        system_messages = [
-            message for message in messages if message["role"] == "system"
-        ]
-        system_prompt = "\n\n".join(message["content"] for message in system_messages)
-
-        compatible_messages = [
-            message for message in messages if message["role"] in ("user", "assistant")
-        ]
-        anthropic_messages = [
-            MessageParam(
-                role=message["role"],
-                content=message["content"],
-            )
-            for message in compatible_messages
-            if message["role"] in ("user", "assistant")  # for typing
-        ]
+        system_parts: list[str] = []
+        anthropic_messages: list[MessageParam] = []
+        outstanding_messages: list[dict[str, str]] = []
+        for message in messages:
+            role = message["role"]
+            if role == "system":
+                system_parts.append(message["content"])
+            elif role in ("user", "assistant"):
+                anthropic_messages.append(
+                    MessageParam(
+                        role=role,
+                        content=message["content"],
+                    )
+                )
+            else:
+                outstanding_messages.append(message)
+        system_prompt = "\n\n".join(system_parts)
 
-        outstanding_messages = [
-            message
-            for message in messages
-            if message not in system_messages and message not in compatible_messages
-        ]
         if outstanding_messages:
             self.log.warning(
                 "Some messages were not included in the prompt",
@@ -335,7 +632,7 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         if model_config.api_base is not None:
             self.log.warning("Ignoring api_base for Claude models")
 
-        client = AsyncAnthropic(api_key=get_secret("ANTHROPIC_API_KEY"))
+        client = await self._get_anthropic_client(get_secret("ANTHROPIC_API_KEY"))
         async with client.messages.stream(
             max_tokens=model_config.max_output_tokens,
             system=system_prompt,
@@ -364,7 +661,8 @@ class Prompt(StreamingAction[Inputs, Outputs]):
 
         model_name = model_config.model.removeprefix("ollama/")
 
-        headers = {}
+        # the body is serialized straight to bytes, rather than via str with `json=`
+        headers = {"Content-Type": "application/json"}
         if model_config.auth_token is not None:
             headers["Authorization"] = f"Bearer {model_config.auth_token}"
 
@@ -388,12 +686,13 @@ class Prompt(StreamingAction[Inputs, Outputs]):
             "options": options,
         }
 
-        def process_completion(completion):
-            if not completion:
+        def process_completion(line: bytes):
+            if not line:
                 return None
             try:
-                data = json.loads(completion)
-            except json.JSONDecodeError:
+                # json_loads accepts bytes, so each line is decoded exactly once
+                data = json_loads(line)
+            except ValueError:  # JSONDecodeError or UnicodeDecodeError
                 return None
             if (
                 not isinstance(data, dict)
@@ -406,27 +705,33 @@ class Prompt(StreamingAction[Inputs, Outputs]):
             if delta:
                 return delta
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                api_url,
-                json=data,
-                headers=headers,
-            ) as response:
-                response.raise_for_status()
-
-                # can't use `response.json` cus of unexpected mimetype: application/x-ndjson
-                buffer = ""
-                async for completion in response.content.iter_any():
-                    buffer += completion.decode()
-                    while "\n" in buffer:
-                        json_, buffer = buffer.split("\n", 1)
-                        completion = process_completion(json_)
-                        if completion is not None:
-                            yield completion, None
-                if buffer:
-                    completion = process_completion(buffer)
+        session = await self._get_session()
+        async with session.post(
+            api_url,
+            data=json_dumps_bytes(data),
+            headers=headers,
+        ) as response:
+            response.raise_for_status()
+
+            # can't use `response.json` cus of unexpected mimetype: application/x-ndjson
+            # buffer raw bytes so multi-byte characters split across chunks stay intact
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(OLLAMA_READ_CHUNK_SIZE):
+                buffer += chunk
+                newline_index = buffer.rfind(b"\n")
+                if newline_index == -1:
+                    continue
+                # split all complete lines at once, and keep the trailing partial line
+                lines = bytes(buffer[:newline_index]).splitlines()
+                del buffer[: newline_index + 1]
+                for line in lines:
+                    completion = process_completion(line)
                     if completion is not None:
                         yield completion, None
+            if buffer:
+                completion = process_completion(bytes(buffer))
+                if completion is not None:
+                    yield completion, None
 
     async def _invoke_litellm(
         self,
@@ -472,60 +777,59 @@ class Prompt(StreamingAction[Inputs, Outputs]):
 
         client = None
         tool_index = None
-        try:
-            if model_config.model.startswith("gpt"):
-                from openai import AsyncOpenAI
-
-                client = AsyncOpenAI(api_key=openai_api_key)
+        if get_provider(model_config.model) is Provider.OPENAI:
+            client = await self._get_openai_client(openai_api_key)
 
-            completion: litellm.ModelResponse  # pyright: ignore[reportPrivateImportUsage]
-            with prompt_env_context_singleton:
-                async for completion in await litellm.acompletion(  # type: ignore
-                    stream=True,
-                    messages=messages,
-                    client=client,
-                    model=model_config.model,
-                    temperature=model_config.temperature,
-                    max_tokens=model_config.max_output_tokens,
-                    top_p=model_config.top_p,
-                    frequency_penalty=model_config.frequency_penalty,
-                    presence_penalty=model_config.presence_penalty,
-                    base_url=model_config.api_base,
-                    extra_headers=headers,
-                    **schema_kwargs,
-                    # **model_config.model_dump(),
-                ):
-                    delta_obj = completion.choices[0].delta  # type: ignore
-                    if schema is not None and use_tool_calling:
-                        if delta_obj.tool_calls is not None:
-                            tool_call = delta_obj.tool_calls[0]
-                            tool_index = tool_call.index
-                            delta_string = tool_call.function.arguments
-                        else:
-                            delta_string = None
-                    else:
-                        delta_string = delta_obj.content
-                    if delta_string is None:
-                        break
-                    yield delta_string, tool_index
-        finally:
-            if client is not None:
-                await client.close()
+        completion: litellm.ModelResponse  # pyright: ignore[reportPrivateImportUsage]
+        configure_prompt_env()
+        async for completion in await litellm.acompletion(  # type: ignore
+            stream=True,
+            messages=messages,
+            client=client,
+            model=model_config.model,
+            temperature=model_config.temperature,
+            max_tokens=model_config.max_output_tokens,
+            top_p=model_config.top_p,
+            frequency_penalty=model_config.frequency_penalty,
+            presence_penalty=model_config.presence_penalty,
+            base_url=model_config.api_base,
+            extra_headers=headers,
+            **schema_kwargs,
+            # **model_config.model_dump(),
+        ):
+            delta_obj = completion.choices[0].delta  # type: ignore
+            if schema is not None and use_tool_calling:
+                if delta_obj.tool_calls is not None:
+                    tool_call = delta_obj.tool_calls[0]
+                    tool_index = tool_call.index
+                    delta_string = tool_call.function.arguments
+                else:
+                    delta_string = None
+            else:
+                delta_string = delta_obj.content
+            if delta_string is None:
+                break
+            yield delta_string, tool_index
 
     async def invoke_llm(
         self,
         messages: list[dict[str, str]],
         model_config: ModelConfig,
         schema: None | JsonSchemaObject,
-    ) -> AsyncIterator[tuple[str, int | None]]:
+    ) -> AsyncGenerator[tuple[str, int | None], None]:
         # this function returns (delta, tool_index); when filling functions (currently only via litellm),
         # it returns one argument at a time (incrementing tool_index)
-        if model_config.model.startswith("claude") and schema is None:
+        provider = get_provider(model_config.model)
+        if schema is not None:
+            # structured outputs are only supported via litellm
+            provider = Provider.LITELLM
+
+        if provider is Provider.ANTHROPIC:
             iterator = self._invoke_anthropic(
                 messages=messages,
                 model_config=model_config,
             )
-        elif model_config.model.startswith("ollama/") and schema is None:
+        elif provider is Provider.OLLAMA:
             iterator = self._invoke_ollama(
                 messages=messages,
                 model_config=model_config,
@@ -573,7 +877,7 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         if tool_responses:
             try:
                 for tool_response in tool_responses.values():
-                    data |= json.loads(tool_response)
+                    data |= json_loads(tool_response)
             except json.JSONDecodeError:
                 self.log.exception(
                     "Failed to parse JSON response", tool_responses=tool_responses
@@ -581,7 +885,7 @@ class Prompt(StreamingAction[Inputs, Outputs]):
                 return None
         else:
             try:
-                data = json.loads(output)
+                data = json_loads(output)
             except json.JSONDecodeError:
                 self.log.exception("Failed to parse JSON response", output=output)
                 return None
@@ -603,24 +907,98 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         messages: list[dict[str, str]],
         model_config: ModelConfig,
         schema: None | JsonSchemaObject,
-    ) -> AsyncIterator[tuple[str, dict[int, str], dict | None]]:
-        output = ""
-        tool_responses = defaultdict(str)
+    ) -> AsyncIterator[tuple[str, dict[int, list[str]], dict | None]]:
+        # tool responses are yielded as lists of chunks; join them with `join_tool_responses`
+        output_parts: list[str] = []
+        pending_deltas = 0
+        last_yield_time = float("-inf")
+        tool_responses: defaultdict[int, list[str]] = defaultdict(list)
+        depth_trackers: defaultdict[int, JsonDepthTracker] = defaultdict(
+            JsonDepthTracker
+        )
         partial_data = {}
-        async for partial_output, tool_index in self.invoke_llm(
-            messages=messages,
-            model_config=model_config,
-            schema=schema,
-        ):
-            output += partial_output
-            if tool_index is not None:
-                tool_responses[tool_index] += partial_output
-                try:
-                    loaded_output = json.loads(tool_responses[tool_index])
-                    partial_data |= loaded_output
-                except JSONDecodeError:
-                    pass
-            yield output, tool_responses, partial_data
+
+        # consume the stream in its own task, so buffered deltas can be flushed
+        # on time even while the stream stalls;
+        # the bounded queue applies backpressure if the consumer falls behind
+        deltas: asyncio.Queue[tuple[str, int | None] | None] = asyncio.Queue(
+            maxsize=self.stream_yield_max_deltas * 2
+        )
+
+        async def consume_stream():
+            stream = self.invoke_llm(
+                messages=messages,
+                model_config=model_config,
+                schema=schema,
+            )
+            try:
+                async with contextlib.aclosing(stream):
+                    async for delta in stream:
+                        await deltas.put(delta)
+            except asyncio.CancelledError:
+                # the consumer has stopped listening
+                raise
+            except Exception:
+                # wake the consumer, which raises the error by awaiting this task
+                await deltas.put(None)
+                raise
+            await deltas.put(None)
+
+        stream_task = asyncio.create_task(consume_stream())
+        try:
+            while True:
+                if pending_deltas:
+                    remaining = (
+                        last_yield_time + self.stream_yield_interval - time.monotonic()
+                    )
+                    try:
+                        delta = await asyncio.wait_for(deltas.get(), remaining)
+                    except asyncio.TimeoutError:
+                        yield "".join(output_parts), tool_responses, partial_data
+                        pending_deltas = 0
+                        last_yield_time = time.monotonic()
+                        continue
+                else:
+                    delta = await deltas.get()
+                if delta is None:
+                    break
+
+                partial_output, tool_index = delta
+                output_parts.append(partial_output)
+                if tool_index is not None:
+                    tool_responses[tool_index].append(partial_output)
+                    # the arguments can only parse once their top-level object is closed
+                    if depth_trackers[tool_index].feed(partial_output):
+                        try:
+                            loaded_output = json_loads(
+                                "".join(tool_responses[tool_index])
+                            )
+                            partial_data |= loaded_output
+                        except JSONDecodeError:
+                            pass
+
+                # coalesce deltas, so downstream consumers don't do work per token
+                pending_deltas += 1
+                now = time.monotonic()
+                if (
+                    pending_deltas >= self.stream_yield_max_deltas
+                    or now - last_yield_time >= self.stream_yield_interval
+                ):
+                    yield "".join(output_parts), tool_responses, partial_data
+                    pending_deltas = 0
+                    last_yield_time = now
+
+            # raise any error from the stream
+            await stream_task
+        finally:
+            if not stream_task.done():
+                # wait for the stream to be closed before returning
+                stream_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await stream_task
+
+        if pending_deltas:
+            yield "".join(output_parts), tool_responses, partial_data
 
     async def run(self, inputs: Inputs) -> AsyncIterator[Outputs]:
         if inputs.model is None:
@@ -629,28 +1007,36 @@ class Prompt(StreamingAction[Inputs, Outputs]):
             override_attrs = inputs.model.model_dump(exclude_defaults=True)
             resolved_model = inputs._default_model.model_copy(update=override_attrs)
 
-        messages = self.build_messages(
+        messages = self.assemble_messages(
             inputs.prompt,
             resolved_model,
             inputs.quote_style,
         )
+        if max_token_bound(messages) > resolved_model.max_prompt_tokens:
+            # tokenizing is CPU-bound, keep it off the event loop
+            messages = await asyncio.to_thread(
+                self.trim_messages, messages, resolved_model
+            )
 
         # resolve schema
         if inputs.output_schema is None:
             schema = None
         else:
-            schema = JsonSchemaObject(
-                type="object",
-                properties=inputs.output_schema,
-            )
+            schema, _ = self.resolve_schema(inputs.output_schema)
+            if schema is None:
+                # invalid schemas resolve to None; construct it again to raise the error
+                schema = JsonSchemaObject(
+                    type="object",
+                    properties=inputs.output_schema,
+                )
 
         output = ""
-        tool_responses = defaultdict(str)
+        tool_responses: dict[int, list[str]] = {}
         async for attempt in tenacity.AsyncRetrying(
-            wait=tenacity.wait_random_exponential(min=1, max=60),
+            wait=retry_wait,
             # let it timeout via `action_timeout`
             # stop=tenacity.stop_after_attempt(10),
-            retry=tenacity.retry_if_exception_type(retry_errors),
+            retry=retry_condition,
             before_sleep=tenacity.before_sleep_log(
                 self.log,  # pyright: ignore [reportArgumentType]
                 logging.WARNING,
@@ -666,7 +1052,8 @@ class Prompt(StreamingAction[Inputs, Outputs]):
                     model_config=resolved_model,
                     schema=schema,
                 ):
-                    yield Outputs(
+                    # skip validation for intermediate outputs, we built them ourselves
+                    yield Outputs.model_construct(
                         result=output,
                         response=output,
                         data=partial_data or None,
@@ -693,7 +1080,7 @@ class Prompt(StreamingAction[Inputs, Outputs]):
         # validate and yield final data
         if inputs.output_schema is not None:
             data = self.parse_structured_response(
-                tool_responses, output, inputs.output_schema
+                join_tool_responses(tool_responses), output, inputs.output_schema
             )
             if data is None:
                 raise RuntimeError(
@@ -706,6 +1093,9 @@ class Prompt(StreamingAction[Inputs, Outputs]):
             )
 
 
+atexit.register(Prompt._close_all_sync)
+
+
 # if __name__ == "__main__":
 #     from aijson.tests.utils import run_action_manually
 #
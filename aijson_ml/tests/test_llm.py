@@ -1,5 +1,9 @@
+import asyncio
 import datetime
+import gc
+import json
 import os
+import weakref
 from typing import Literal
 from unittest.mock import patch
 
@@ -9,7 +13,15 @@ import tenacity
 from openai.types.chat import ChatCompletionChunk
 from openai.types.chat.chat_completion_chunk import ChoiceDelta, Choice
 
-from aijson_ml.actions.llm import Inputs, Prompt
+from aijson_ml.actions import llm
+from aijson_ml.actions.llm import (
+    Inputs,
+    Prompt,
+    JsonDepthTracker,
+    count_message_tokens,
+    join_tool_responses,
+    max_token_bound,
+)
 from aijson_ml.utils.prompt_context import (
     TextElement,
     ContextElement,
@@ -17,6 +29,7 @@ from aijson_ml.utils.prompt_context import (
     QuoteStyle,
 )
 from aijson.models.config.model import ModelConfig
+from aijson.models.json_schema import JsonSchemaObject
 
 
 def create_stream_chat_completion(
@@ -314,6 +327,180 @@ Milk, eggs, cheese, Milk, eggs, cheese, Milk, eggs, cheese, Milk, eggs, cheese,
     )
 
 
+@pytest.mark.parametrize("model", ["gpt-3.5-turbo-16k", "gpt-4o"])
+def test_count_message_tokens(model):
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "Apple, bananas, oranges, tomatoes, " * 20},
+        {"role": "assistant", "content": "Fruit salad."},
+    ]
+    expected = litellm.token_counter(model=model, messages=messages)
+
+    assert count_message_tokens(model, messages) == expected
+    # cached counts must not drift on repeated calls
+    assert count_message_tokens(model, messages) == expected
+    assert count_message_tokens(model, []) == litellm.token_counter(
+        model=model, messages=[]
+    )
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "a",
+        "Apple, bananas, oranges, tomatoes, " * 20,
+        "りんご、バナナ、オレンジ、トマト。" * 20,
+        "🍎🍌🍊🍅" * 20,
+    ],
+)
+@pytest.mark.parametrize("model", ["gpt-3.5-turbo-16k", "gpt-4o"])
+def test_max_token_bound(model, content):
+    messages = [
+        {"role": "system", "content": content},
+        {"role": "user", "content": content},
+    ]
+    assert max_token_bound(messages) >= litellm.token_counter(
+        model=model, messages=messages
+    )
+
+
+def test_json_depth_tracker():
+    document = '{"a": "x\\\\", "b": ["}\\"]{", {"c": "\\u007b"}], "d": {}}'
+    assert json.loads(document)
+
+    # the document must only be reported closed at its very end, however it's split
+    for chunk_size in range(1, len(document) + 1):
+        tracker = JsonDepthTracker()
+        closed_at = [
+            i
+            for i in range(0, len(document), chunk_size)
+            if tracker.feed(document[i : i + chunk_size])
+        ]
+        assert closed_at == [(len(document) - 1) // chunk_size * chunk_size]
+        assert tracker.depth == 0
+        assert not tracker.in_string
+
+
+async def test_iterate_invoke_llm_tool_calls(action, inputs):
+    deltas = [
+        ('{"summary": "braces {', 0),
+        (' in [strings] \\"}\\" ",', 0),
+        (' "items": [1, {"a": 2}]', 0),
+        ("}", 0),
+        ('{"other": true}', 1),
+    ]
+
+    async def mock_invoke_llm(*args, **kwargs):
+        for delta in deltas:
+            yield delta
+
+    partial_datas = []
+    with (
+        patch.object(action, "invoke_llm", mock_invoke_llm),
+        patch.object(Prompt, "stream_yield_interval", 0),
+    ):
+        async for output, tool_responses, partial_data in action.iterate_invoke_llm(
+            messages=[],
+            model_config=inputs._default_model,
+            schema=None,
+        ):
+            partial_datas.append(dict(partial_data))
+
+    assert output == "".join(delta for delta, _ in deltas)
+    assert join_tool_responses(tool_responses) == {
+        0: "".join(delta for delta, index in deltas if index == 0),
+        1: '{"other": true}',
+    }
+    assert partial_datas == [
+        {},
+        {},
+        {},
+        expected_data := {
+            "summary": 'braces { in [strings] "}" ',
+            "items": [1, {"a": 2}],
+        },
+        expected_data | {"other": True},
+    ]
+
+
+async def test_iterate_invoke_llm_coalesces_deltas(action, inputs):
+    async def mock_invoke_llm(*args, **kwargs):
+        for i in range(40):
+            yield f"{i} ", None
+
+    outputs = []
+    with (
+        patch.object(action, "invoke_llm", mock_invoke_llm),
+        patch.object(Prompt, "stream_yield_interval", 60),
+    ):
+        async for output, _, _ in action.iterate_invoke_llm(
+            messages=[],
+            model_config=inputs._default_model,
+            schema=None,
+        ):
+            outputs.append(output)
+
+    # the first delta is yielded immediately, then every 16 deltas, then the remainder
+    assert [len(output.split()) for output in outputs] == [1, 17, 33, 40]
+
+
+async def test_iterate_invoke_llm_flushes_during_stall(action, inputs):
+    produced = []
+
+    async def mock_invoke_llm(*args, **kwargs):
+        for delta, delay in [("a", 0), ("b", 0), ("c", 0.5)]:
+            await asyncio.sleep(delay)
+            produced.append(delta)
+            yield delta, None
+
+    outputs = []
+    with (
+        patch.object(action, "invoke_llm", mock_invoke_llm),
+        patch.object(Prompt, "stream_yield_interval", 0.05),
+    ):
+        async for output, _, _ in action.iterate_invoke_llm(
+            messages=[],
+            model_config=inputs._default_model,
+            schema=None,
+        ):
+            outputs.append((output, "".join(produced)))
+
+    # "b" is buffered, then flushed while the stream stalls before "c"
+    assert [output for output, _ in outputs] == ["a", "ab", "abc"]
+    assert outputs[1] == ("ab", "ab")
+
+
+@pytest.mark.parametrize("delay", [0, 60])
+async def test_iterate_invoke_llm_closes_stream(action, inputs, delay):
+    produced = []
+    stream_closed = asyncio.Event()
+
+    async def mock_invoke_llm(*args, **kwargs):
+        try:
+            while True:
+                produced.append("a")
+                yield "a", None
+                # either backpressure from the queue or a stalled stream
+                await asyncio.sleep(delay)
+        finally:
+            stream_closed.set()
+
+    with patch.object(action, "invoke_llm", mock_invoke_llm):
+        iterator = action.iterate_invoke_llm(
+            messages=[],
+            model_config=inputs._default_model,
+            schema=None,
+        )
+        await anext(iterator)
+        # let the stream run ahead of the consumer
+        await asyncio.sleep(0.01)
+        await iterator.aclose()
+
+    assert stream_closed.is_set()
+    assert len(produced) <= Prompt.stream_yield_max_deltas * 2 + 2
+
+
 async def test_rate_limit_retry(
     log,
     mock_tenacity,
@@ -343,3 +530,177 @@ async def test_rate_limit_retry(
             "event": "Retrying <unknown> in 0.0 seconds as it raised RateLimitError: litellm.RateLimitError: tenacityyyy retry pleaseeee.",
             "log_level": "warning",
         }
+
+
+# a chunk size of 1 splits every line and multi-byte character across reads
+@pytest.mark.parametrize("chunk_size", [llm.OLLAMA_READ_CHUNK_SIZE, 1, 5])
+async def test_ollama_stream(action, mock_aioresponse, chunk_size):
+    chunks = ["Bonjour, ", "ça va? ", "🌍"]
+    body = b"".join(
+        json.dumps(
+            {"message": {"role": "assistant", "content": chunk}}, ensure_ascii=False
+        ).encode()
+        + b"\n"
+        for chunk in chunks
+    )
+    body += json.dumps({"done": True}).encode()
+    mock_aioresponse.post("http://ollama.test/api/chat", body=body)
+
+    model_config = ModelConfig(
+        model="ollama/llama3",
+        api_base="http://ollama.test",
+    )
+    with patch.object(llm, "OLLAMA_READ_CHUNK_SIZE", chunk_size):
+        result = [
+            delta
+            async for delta, _ in action._invoke_ollama(
+                messages=[{"role": "user", "content": "Hi"}],
+                model_config=model_config,
+            )
+        ]
+
+    assert result == chunks
+    ((request,),) = mock_aioresponse.requests.values()
+    assert json.loads(request.kwargs["data"]) == {
+        "model": "llama3",
+        "messages": [{"role": "user", "content": "Hi"}],
+        "stream": True,
+        "options": {"num_predict": model_config.max_output_tokens},
+    }
+    # the test event loop is closed without finalizing async generators
+    await Prompt.aclose_all()
+
+
+def test_sessions_closed_with_event_loop():
+    async def get_session():
+        return await Prompt._get_session(), asyncio.get_running_loop()
+
+    results = [asyncio.run(get_session()) for _ in range(5)]
+    assert all(session.closed for session, _ in results)
+    assert not any(loop in Prompt._sessions for _, loop in results)
+    assert not any(loop in Prompt._loop_cleanups for _, loop in results)
+
+    # nothing cached keeps the closed loops alive
+    loop_refs = [weakref.ref(loop) for _, loop in results]
+    del results
+    gc.collect()
+    assert all(loop_ref() is None for loop_ref in loop_refs)
+
+
+def test_clients_closed_with_event_loop():
+    async def get_clients():
+        return (
+            await Prompt._get_anthropic_client("key"),
+            await Prompt._get_openai_client("key"),
+            asyncio.get_running_loop(),
+        )
+
+    results = [asyncio.run(get_clients()) for _ in range(5)]
+    assert all(client.is_closed() for *clients, _ in results for client in clients)
+    assert not any(loop in Prompt._anthropic_clients for *_, loop in results)
+    assert not any(loop in Prompt._openai_clients for *_, loop in results)
+
+    loop_refs = [weakref.ref(loop) for *_, loop in results]
+    del results
+    gc.collect()
+    assert all(loop_ref() is None for loop_ref in loop_refs)
+
+
+def test_sessions_of_closed_loops_are_forgotten():
+    loop = asyncio.new_event_loop()
+    session = loop.run_until_complete(Prompt._get_session())
+    loop.run_until_complete(session.close())
+    # closed without finalizing async generators, unlike `asyncio.run`
+    loop.close()
+    assert loop in Prompt._sessions
+
+    asyncio.run(Prompt._get_session())
+    assert loop not in Prompt._sessions
+    assert loop not in Prompt._loop_cleanups
+
+
+def test_resolve_schema_is_cached():
+    schema = {"action_items": {"type": "array", "items": {"type": "string"}}}
+    schema_object, model = Prompt.resolve_schema(schema)
+    assert schema_object is not None
+    assert model is not None
+
+    # equal schemas share the compiled model
+    assert Prompt.resolve_schema(json.loads(json.dumps(schema))) == (
+        schema_object,
+        model,
+    )
+    # an already parsed schema serializes differently, so it's cached separately
+    parsed_schema = Inputs(prompt="", output_schema=schema).output_schema
+    assert parsed_schema is not None
+    parsed_model = Prompt.resolve_schema(parsed_schema)[1]
+    assert parsed_model is not None
+    assert Prompt.resolve_schema(parsed_schema)[1] is parsed_model
+    assert parsed_model.model_json_schema() == model.model_json_schema()
+
+
+@pytest.mark.parametrize(
+    "model, schema_kwarg",
+    [("gpt-4o", "response_format"), ("claude-3-haiku-20240307", "tools")],
+)
+async def test_resolved_schema_kwargs(action, model, schema_kwarg):
+    output_schema = Inputs(
+        prompt="",
+        output_schema={
+            "action_items": {"type": "array", "items": {"type": "string"}},
+        },
+    ).output_schema
+    assert output_schema is not None
+    # the schema is dumped as it was before resolved schemas were cached
+    expected_schema = JsonSchemaObject(
+        type="object", properties=output_schema
+    ).model_dump(exclude_unset=True)
+    assert expected_schema == {
+        "type": "object",
+        "properties": {
+            "action_items": {
+                "type": "array",
+                "items": {
+                    "type": "string",
+                    "required": [],
+                    "additionalProperties": False,
+                },
+                "required": [],
+                "additionalProperties": False,
+            },
+        },
+        "required": ["action_items"],
+        "additionalProperties": False,
+    }
+
+    calls = []
+    stream_chat_completion = create_stream_chat_completion("{}")
+
+    async def mock_acompletion(*args, **kwargs):
+        calls.append(kwargs)
+        return await stream_chat_completion(*args, **kwargs)
+
+    async def mock_get_openai_client(*args, **kwargs):
+        return None
+
+    with (
+        patch.object(litellm, "acompletion", mock_acompletion),
+        patch.object(action, "_get_openai_client", mock_get_openai_client),
+    ):
+        # the second resolution hits the cache
+        for _ in range(2):
+            schema, _ = Prompt.resolve_schema(output_schema)
+            async for _ in action._invoke_litellm(
+                messages=[{"role": "user", "content": "Hi"}],
+                model_config=ModelConfig(model=model),
+                schema=schema,
+            ):
+                pass
+
+    if schema_kwarg == "response_format":
+        dumped_schemas = [
+            call["response_format"]["json_schema"]["schema"] for call in calls
+        ]
+    else:
+        dumped_schemas = [call["tools"][0]["function"]["parameters"] for call in calls]
+    assert dumped_schemas == [expected_schema, expected_schema]
@@ -0,0 +1,73 @@
+import copy
+import pickle
+
+import pydantic
+import pytest
+
+from aijson_ml.utils.prompt_context import (
+    ContextElement,
+    ContextLink,
+    ContextTemplate,
+    ContextVar,
+)
+
+
+@pytest.mark.parametrize(
+    "declaration, context, expected",
+    [
+        (ContextVar(var="a.b"), {"a": {"b": "foo"}}, ("foo", "A B")),
+        (ContextVar(var="a", heading="H"), {"a": 3}, ("3", "H")),
+        (ContextVar(var="a", heading="{{ h }}!"), {"a": 1.5, "h": "x"}, ("1.5", "x!")),
+        (ContextTemplate(text="{{ a }}", heading="H"), {"a": [1]}, ("[1]", "H")),
+    ],
+)
+async def test_transform_from_config(log, declaration, context, expected):
+    element = await declaration.transform_from_config(log, context)
+    assert element == ContextElement(value=expected[0], heading=expected[1])
+
+
+@pytest.mark.parametrize(
+    "context",
+    [
+        {},
+        {"a": [1, 2]},
+        {"a": {"k": 1}},
+        {"a": None},
+    ],
+)
+async def test_transform_from_config_rejects_non_strings(log, context):
+    with pytest.raises(pydantic.ValidationError):
+        await ContextVar(var="a").transform_from_config(log, context)
+
+
+@pytest.mark.parametrize(
+    "declaration",
+    [
+        ContextVar(var="a.b"),
+        ContextVar(var="a.b", heading="{{ h }}!"),
+        ContextTemplate(text="{{ a.b }}", heading="{{ h }}"),
+    ],
+)
+async def test_declarations_copy_and_pickle(log, declaration):
+    context = {"a": {"b": "foo"}, "h": "x"}
+    expected = await declaration.transform_from_config(log, context)
+    for copied in [
+        copy.deepcopy(declaration),
+        declaration.model_copy(deep=True),
+        pickle.loads(pickle.dumps(declaration)),
+    ]:
+        assert copied == declaration
+        assert await copied.transform_from_config(log, context) == expected
+
+
+@pytest.mark.parametrize(
+    "declaration, update",
+    [
+        (ContextVar(var="a.b"), {"var": "c_d"}),
+        (ContextLink(link="a.b"), {"link": "c_d"}),
+    ],
+)
+async def test_inferred_heading_follows_updates(log, declaration, update):
+    updated = declaration.model_copy(update=update)
+    element = await updated.transform_from_config(log, {"c_d": "foo"})
+    assert element == ContextElement(value="foo", heading="C D")
@@ -0,0 +1,93 @@
+from typing import ClassVar
+
+import pytest
+from aijson.models.config.value_declarations import TextDeclaration
+from aijson.models.io import DefaultOutputOutputs
+from aijson.utils import rendering_utils as aijson_rendering_utils
+
+from aijson_ml.utils.rendering_utils import (
+    compile_template,
+    is_literal_template,
+    render_template,
+    render_text,
+    render_var,
+)
+
+
+class ResultOutputs(DefaultOutputOutputs):
+    _default_output: ClassVar[str] = "result"
+
+    result: str
+
+
+@pytest.fixture
+def context():
+    return {
+        "name": "Alice",
+        "items": [1, 2],
+        "action": ResultOutputs(result="done"),
+    }
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "User Input",
+        "User Input\n",
+        "line 1\r\nline 2\r\n",
+        "",
+        "Hello {{ name }}!",
+        "{% for item in items %}{{ item }}\n{% endfor %}",
+        "{{ items }}",
+        "{{ missing }}",
+        "{{ action }}",
+    ],
+)
+async def test_render_template_matches_aijson(template, context):
+    expected = await aijson_rendering_utils.render_template(template, context)
+    rendered = await render_template(template, context)
+    assert rendered == expected
+    assert type(rendered) is type(expected)
+    assert await render_text(template, context) == await TextDeclaration(
+        text=template
+    ).render(context)
+
+
+@pytest.mark.parametrize(
+    "var",
+    [
+        "name",
+        "items",
+        "items[0]",
+        "missing",
+        "action",
+    ],
+)
+async def test_render_var_matches_aijson(var, context):
+    expected = await aijson_rendering_utils.render_var(var, context)
+    rendered = await render_var(var, context)
+    assert rendered == expected
+    assert type(rendered) is type(expected)
+
+
+@pytest.mark.parametrize(
+    "template, is_literal",
+    [
+        ("", True),
+        ("\n", True),
+        ("\n\n", True),
+        ("User Input", True),
+        ("User Input\n", True),
+        ("User Input\n\n", True),
+        ("  padded  \n ", True),
+        ("{ braces } and }}", True),
+        ("line 1\r\nline 2", False),
+        ("{# comment #}", False),
+        ("{% raw %}{{ x }}{% endraw %}", False),
+    ],
+)
+async def test_literal_templates_match_jinja(template, is_literal):
+    assert is_literal_template(template) is is_literal
+    # render through jinja itself, bypassing the literal fast path
+    expected = await compile_template(template).render_async()
+    assert await render_template(template, {}) == expected
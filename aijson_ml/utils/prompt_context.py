@@ -1,8 +1,10 @@
 import enum
-from typing import Union, Any, Literal
-from typing_extensions import assert_never
+import functools
+from typing import TYPE_CHECKING, Union, Any, Literal
+
+if TYPE_CHECKING:
+    import structlog.stdlib
 
-import structlog.stdlib
 from pydantic import ConfigDict
 
 from aijson import Field
@@ -20,13 +22,45 @@ from aijson.models.config.value_declarations import (
     # ConstDeclaration,
 )
 from aijson.models.primitives import TemplateString
+from aijson_ml.utils.rendering_utils import (
+    render_text,
+    render_var,
+)
+
+
+_HEADING_SEPARATORS = str.maketrans("._", "  ")
 
 
-class QuoteStyle(enum.Enum):
+@functools.lru_cache(maxsize=1024)
+def _infer_heading(name: str) -> str:
+    return name.translate(_HEADING_SEPARATORS).title()
+
+
+class QuoteStyle(str, enum.Enum):
     BACKTICKS = "backticks"
     XML = "xml"
 
 
+def _backticks_affixes(heading: str) -> tuple[str, str]:
+    return f"{heading}:\n```\n", "\n```"
+
+
+def _xml_affixes(heading: str) -> tuple[str, str]:
+    return f"<{heading}>\n", f"\n</{heading}>"
+
+
+_AFFIXES = {
+    QuoteStyle.BACKTICKS: _backticks_affixes,
+    QuoteStyle.XML: _xml_affixes,
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _quote_affixes(heading: str, quote_style: QuoteStyle) -> tuple[str, str]:
+    # the same few headings are formatted over and over, so only the value varies
+    return _AFFIXES[quote_style](heading)
+
+
 class PromptElementBase(StrictModel):
     def as_string(
         self,
@@ -36,6 +70,10 @@ class PromptElementBase(StrictModel):
 
 
 class RoleElement(PromptElementBase):
+    model_config = ConfigDict(
+        frozen=True,
+    )
+
     role: Literal["user", "system", "assistant"]
 
     def as_string(
@@ -49,6 +87,10 @@ class TextElement(PromptElementBase):
     # copy the documentation from TextDeclaration.text
     # can't inherit TextDeclaration or the object will turn into a string by action_service
     # TODO explore compositional methods for this instead of inheritance?
+    model_config = ConfigDict(
+        frozen=True,
+    )
+
     text: TemplateString = TextDeclaration.model_fields["text"]  # type: ignore
     role: Literal["user", "system", "assistant"] | None = None
 
@@ -66,6 +108,7 @@ class ContextElement(PromptElementBase, TransformsFrom):
 
     model_config = ConfigDict(
         coerce_numbers_to_str=True,
+        frozen=True,
     )
 
     value: str
@@ -91,23 +134,8 @@ class ContextElement(PromptElementBase, TransformsFrom):
         quote_style
             The style of quotes to use. Defaults to XML-style quotes.
         """
-        # Format the value as a string
-        # if isinstance(self.value, list):
-        #     valstr = "\n".join(str(item) for item in self.value)
-        # else:
-        valstr = str(self.value)
-
-        if quote_style == QuoteStyle.BACKTICKS:
-            return f"""{self.heading}:
-```
-{valstr}
-```"""
-        elif quote_style == QuoteStyle.XML:
-            return f"""<{self.heading}>
-{valstr}
-</{self.heading}>"""
-        else:
-            assert_never(quote_style)
+        prefix, suffix = _quote_affixes(self.heading, quote_style)
+        return prefix + self.value + suffix
 
 
 PromptElement = Union[
@@ -157,14 +185,18 @@ If `quote_style` is set to `xml`, the heading will be wrapped in XML tags, accor
     )
 
     async def transform_from_config(
-        self, log: structlog.stdlib.BoundLogger, context: dict[str, Any]
+        self, log: "structlog.stdlib.BoundLogger", context: dict[str, Any]
     ) -> ContextElement:
-        return ContextElement(
-            value=await self.render(context),
-            heading=await TextDeclaration(
-                text=self.heading,
-            ).render(context),
-        )
+        value = await self.render(context)
+        heading = await self.render_heading(context)
+        if isinstance(value, str):
+            # both fields are already strings, so skip validation
+            return ContextElement.model_construct(value=value, heading=heading)
+        # anything else is coerced (numbers) or rejected (undefined, lists, ...)
+        return ContextElement(value=value, heading=heading)
+
+    async def render_heading(self, context: dict[str, Any]) -> str:
+        return await render_text(self.heading, context)
 
 
 class ContextVar(PromptContextInConfigBase, VarDeclaration):
@@ -174,16 +206,13 @@ class ContextVar(PromptContextInConfigBase, VarDeclaration):
 
     heading: TemplateString | None = None
 
-    async def transform_from_config(
-        self, log: structlog.stdlib.BoundLogger, context: dict[str, Any]
-    ) -> ContextElement:
-        if self.heading is not None:
-            return await super().transform_from_config(log, context)
-        inferred_heading = self.var.replace(".", " ").replace("_", " ").title()
-        return ContextElement(
-            value=await self.render(context),
-            heading=inferred_heading,
-        )
+    async def render(self, context: dict[str, Any]) -> Any:
+        return await render_var(self.var, context)
+
+    async def render_heading(self, context: dict[str, Any]) -> str:
+        if self.heading is None:
+            return _infer_heading(self.var)
+        return await super().render_heading(context)
 
 
 class ContextLink(PromptContextInConfigBase, LinkDeclaration):
@@ -193,16 +222,13 @@ class ContextLink(PromptContextInConfigBase, LinkDeclaration):
 
     heading: TemplateString | None = None
 
-    async def transform_from_config(
-        self, log: structlog.stdlib.BoundLogger, context: dict[str, Any]
-    ) -> ContextElement:
-        if self.heading is not None:
-            return await super().transform_from_config(log, context)
-        inferred_heading = self.link.replace(".", " ").replace("_", " ").title()
-        return ContextElement(
-            value=await self.render(context),
-            heading=inferred_heading,
-        )
+    async def render(self, context: dict[str, Any]) -> Any:
+        return await render_var(self.link, context)
+
+    async def render_heading(self, context: dict[str, Any]) -> str:
+        if self.heading is None:
+            return _infer_heading(self.link)
+        return await super().render_heading(context)
 
 
 class ContextTemplate(PromptContextInConfigBase, TextDeclaration):
@@ -210,6 +236,9 @@ class ContextTemplate(PromptContextInConfigBase, TextDeclaration):
     A template string for prompt context in config.
     """
 
+    async def render(self, context: dict[str, Any]) -> Any:
+        return await render_text(self.text, context)
+
 
 class ContextLambda(PromptContextInConfigBase, LambdaDeclaration):
     """
@@ -0,0 +1,67 @@
+import functools
+from typing import Any
+
+import jinja2
+
+from aijson.models.io import DefaultOutputOutputs
+from aijson.models.primitives import ContextVarName, ContextVarPath, TemplateString
+from aijson.utils.jinja_utils import NativeEnvironment
+
+# same configuration as the environment in `aijson.utils.rendering_utils`
+_jinja_env = NativeEnvironment(
+    extensions=["jinja2.ext.loopcontrols"],
+    enable_async=True,
+)
+
+
+_TEMPLATE_MARKERS = ("{{", "{%", "{#")
+
+
+def is_literal_template(template_string: TemplateString) -> bool:
+    # carriage returns are normalized by jinja, leave those to the template engine
+    return "\r" not in template_string and not any(
+        marker in template_string for marker in _TEMPLATE_MARKERS
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template_string: TemplateString) -> jinja2.Template:
+    return _jinja_env.from_string(template_string)
+
+
+async def render_template(
+    template_string: TemplateString,
+    context: dict[ContextVarName, Any],
+) -> Any:
+    """
+    Equivalent to `aijson.utils.rendering_utils.render_template`,
+    but compiled templates are cached by their source.
+    """
+    if is_literal_template(template_string):
+        # jinja drops a single trailing newline, and renders empty output as None
+        return template_string.removesuffix("\n") or None
+    template = compile_template(template_string)
+    rendered = await template.render_async(context)
+    if isinstance(rendered, DefaultOutputOutputs):
+        return await render_var(rendered._default_output, rendered.model_dump())
+    return rendered
+
+
+async def render_var(
+    var: ContextVarPath,
+    context: dict[ContextVarName, Any],
+) -> Any:
+    return await render_template(f"{{{{ {var} }}}}", context)
+
+
+async def render_text(
+    template_string: TemplateString,
+    context: dict[ContextVarName, Any],
+) -> str:
+    """
+    Render a template to a string, like `TextDeclaration.render`.
+    """
+    rendered = await render_template(template_string, context)
+    if not rendered:
+        return ""
+    return str(rendered)